@@ -1,6 +1,5 @@
-import math
-
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 from utils.embedders import TimestepEmbedder
@@ -42,8 +41,10 @@ class TMSA(nn.Module):
         self.W_vs = nn.Linear(d_model, d_model)
         self.W_vt = nn.Linear(d_model, d_model)
 
-        # Attention bias for controlling the attention weights
-        self.attn_bias = nn.Parameter(torch.zeros(1, 1, 1, 1))
+        # Attention bias for controlling the attention weights.
+        # Unused ( see "scaled_dot_product_attention" ): frozen, so that DDP doesn't wait for its gradient,
+        # and kept only to load existing checkpoints.
+        self.attn_bias = nn.Parameter(torch.zeros(1, 1, 1, 1), requires_grad=False)
 
     def scaled_dot_product_attention(self, Q, K, V, mask=None):
         """
@@ -55,12 +56,11 @@ class TMSA(nn.Module):
         :param mask: Optional mask tensor for preventing attention to certain positions.
         :return: Output tensor of shape (batch_size, num_heads, seq_length, d_k).
         """
-        attn_scores = torch.matmul(Q, K.transpose(-2, -1)) / math.sqrt(self.d_k)
-        attn_scores += self.attn_bias  # Add bias to the attention scores
-        if mask is not None:
-            attn_scores = attn_scores.masked_fill(mask == 0, -1e9)  # Mask invalid positions
-        attn_probs = torch.softmax(attn_scores, dim=-1)
-        output = torch.matmul(attn_probs, V)
+        # attn_bias is a single value added to all the scores, which the softmax cancels out: it's not needed here.
+        # Leaving it out keeps the fused attention kernels ( flash / cuDNN ) available.
+        attn_mask = None if mask is None else mask != 0  # Mask invalid positions
+        # Scores are scaled by 1 / sqrt(d_k), the default of scaled_dot_product_attention
+        output = F.scaled_dot_product_attention(Q, K, V, attn_mask=attn_mask)
         return output
 
     def split_heads(self, x):
@@ -88,7 +88,8 @@ class TMSA(nn.Module):
         Forward pass of the TMSA module.
 
         :param Xs: A Tensor of shape (batch_size, seq_len, d_model) representing spatial embeddings.
-        :param Xt: A Tensor of shape (batch_size, seq_len,d_model) representing temporal embeddings.
+        :param Xt: A Tensor of shape (batch_size, seq_len, d_model) or (batch_size, 1, d_model) representing
+            temporal embeddings. In the latter case the projections are computed once and broadcast over the sequence.
         :param mask: Optional mask for attention.
         :return: A Tensor of shape (batch_size, seq_len, d_model) as the output of the attention mechanism.
         """
@@ -146,8 +147,8 @@ class DiffTBlock(nn.Module):
             It's usually a combination of label and temporal embedding.
         :return: Output tensor of shape (batch_size, seq_len, hidden_size).
         """
-        seq_len = x.shape[1]
-        c = c.unsqueeze(1).repeat(1, seq_len, 1)
+        # The context is the same for every token: it's projected once and broadcast inside TMSA
+        c = c.unsqueeze(1)  # (batch_size, 1, hidden_size)
         x = self.norm1(self.tmsa(x, c)) + x
         x = self.norm2(self.mlp(x)) + x
         return x
@@ -1,11 +1,63 @@
+import copy
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from timm.layers import PatchEmbed
+from torch.utils.checkpoint import checkpoint
 
 from diffit import DiffTBlock, FinalLayer
 from diffit import TimestepEmbedder
-from modeltocopy import get_2d_sincos_pos_embed
 from utils.embedders import LabelEmbedder
+from utils.positional_embeddings import get_2d_sincos_pos_embed_torch
+
+
+def setup_cuda_backends():
+    """
+    Enables the fastest CUDA backends for the model:
+    - TF32 tensor cores for matrix multiplications and cuDNN convolutions.
+    - cuDNN benchmark mode, which picks the fastest convolution algorithm for the ( fixed ) input shapes.
+    - cuDNN backend for torch.nn.functional.scaled_dot_product_attention, used by the TMSA attention.
+    The cuDNN attention backend is picked by default only from PyTorch 2.9; on older versions it's enabled
+    if available.
+    """
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    if hasattr(torch.backends.cuda, "enable_cudnn_sdp"):
+        torch.backends.cuda.enable_cudnn_sdp(True)
+
+
+def _configure_dynamo():
+    """
+    Sets the TorchDynamo options used when compiling the model.
+    Shapes are compiled statically, so the cache must be large enough to keep one graph for each
+    input shape ( e.g. the normal and the classifier-free guidance batch sizes ).
+    """
+    torch._dynamo.config.cache_size_limit = 128
+    # Splits the graphs at DDP buckets boundaries, so that communication overlaps with the backward pass
+    torch._dynamo.config.optimize_ddp = True
+
+
+_compiled_functions = {}
+
+
+def _compiled(fn, **options):
+    """
+    Returns the function compiled with torch.compile, compiling it only at the first call.
+    The function must be a plain function taking the module as first argument ( e.g. "DiffiTSequential.forward_blocks"),
+    not a bound method: this way no compiled closure over a module is stored in the module itself, which can still
+    be deep-copied ( e.g. for EMA ) and pickled.
+
+    :param fn: the function to compile.
+    :param options: options passed to torch.compile.
+    :return: the compiled function.
+    """
+    key = (fn, tuple(sorted(options.items())))
+    if key not in _compiled_functions:
+        _configure_dynamo()
+        _compiled_functions[key] = torch.compile(fn, **options)
+    return _compiled_functions[key]
 
 
 class Tokenizer(nn.Module):
@@ -37,6 +89,20 @@ class Tokenizer(nn.Module):
         return x
 
 
+class GroupNorm32(nn.GroupNorm):
+    """
+    Group Normalization always computed in float32, whatever the dtype of the input.
+    The output is cast back to the dtype of the input.
+    """
+
+    def forward(self, x):
+        """
+        :param x: Input tensor of shape (batch_size, num_channels, height, width).
+        :return: Output tensor of shape (batch_size, num_channels, height, width), with the same dtype of x.
+        """
+        return super(GroupNorm32, self).forward(x.float()).type(x.dtype)
+
+
 class Head(nn.Module):
     """
     Head module consisting of Group Normalization followed by a 2D convolutional layer.
@@ -55,7 +121,7 @@ class Head(nn.Module):
         """
         super(Head, self).__init__()
         assert in_channels % num_groups == 0, "in_channels must be divisible by num_groups"
-        self.groupNorm = nn.GroupNorm(num_groups, in_channels)
+        self.groupNorm = GroupNorm32(num_groups, in_channels)
         self.conv2d = nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding=1)
 
     def forward(self, x):
@@ -68,6 +134,45 @@ class Head(nn.Module):
         return x
 
 
+class Upsample2x(nn.Module):
+    """
+    Upsample module that doubles the height and the width of the input with a nearest neighbour interpolation,
+    followed by a 2D convolutional layer ( with 3x3 Kernel ).
+    Unlike a strided transposed convolution, it doesn't produce checkerboard artifacts.
+    """
+
+    def __init__(self, channels=128):
+        """
+        :param channels: number of channels of the input and of the output.
+        """
+        super(Upsample2x, self).__init__()
+        self.conv2d = nn.Conv2d(channels, channels, 3, 1, 1)
+
+    def forward(self, x):
+        """
+        :param x: Input tensor of shape (batch_size, channels, height, width).
+        :return: Output tensor of shape (batch_size, channels, height * 2, width * 2).
+        """
+        x = F.interpolate(x, scale_factor=2, mode="nearest")
+        x = self.conv2d(x)
+        return x
+
+
+class GroupNormSiLU(GroupNorm32):
+    """
+    Group Normalization followed by a SiLU ( swish ) activation.
+    Having both in a single module lets torch.compile fuse the normalization and the activation in one kernel,
+    so that the feature map is read from memory only once.
+    """
+
+    def forward(self, x):
+        """
+        :param x: Input tensor of shape (batch_size, num_channels, height, width).
+        :return: Output tensor of shape (batch_size, num_channels, height, width).
+        """
+        return F.silu(super(GroupNormSiLU, self).forward(x))
+
+
 class DiffiTResBlock(nn.Module):
     """
     Residual block that applies GroupNorm, SiLU activation, a convolutional layer, and the DiffiT module to the input.
@@ -90,16 +195,18 @@ class DiffiTResBlock(nn.Module):
         assert hidden_size % num_heads == 0, 'hidden_size must be divisible by num_heads'
         assert channels % num_groups == 0, 'patch_size must be divisible by num_groups'
         self.channels = channels
-        self.groupNorm = nn.GroupNorm(num_groups, channels)
-        self.swish = nn.SiLU()
+        self.groupNorm = GroupNormSiLU(num_groups, channels)
         self.conv2d = nn.Conv2d(channels, channels, 3, 1, 1)
         self.diffit = DiffTBlock(hidden_size, num_heads)
         self.x_embedder = PatchEmbed(img_size, patch_size, channels, hidden_size, bias=True)
 
         self.patch_size = patch_size
         self.num_patches = self.x_embedder.num_patches
-        # Will use fixed sin-cos embedding:
-        self.pos_embed = nn.Parameter(torch.zeros(1, self.num_patches, hidden_size), requires_grad=False)
+        # Shapes used by unpatchify, fixed once the image size is known
+        self._unpatch_h = int(self.num_patches ** 0.5)
+        assert self._unpatch_h * self._unpatch_h == self.num_patches, 'patches must form a squared grid'
+        self._patches_shape = (self._unpatch_h, self._unpatch_h, patch_size, patch_size, channels)
+        self._image_shape = (self._unpatch_h * patch_size, self._unpatch_h * patch_size, channels)
         self.final = FinalLayer(hidden_size, patch_size, self.channels)
         self.initialize_weights()
 
@@ -113,10 +220,6 @@ class DiffiTResBlock(nn.Module):
 
         self.apply(_basic_init)
 
-        # Initialize (and freeze) pos_embed by sin-cos embedding:
-        pos_embed = get_2d_sincos_pos_embed(self.pos_embed.shape[-1], int(self.x_embedder.num_patches ** 0.5))
-        self.pos_embed.data.copy_(torch.from_numpy(pos_embed).float().unsqueeze(0))
-
         # Initialize patch_embed like nn.Linear (instead of nn.Conv2d):
         w = self.x_embedder.proj.weight.data
         nn.init.xavier_uniform_(w.view([w.shape[0], -1]))
@@ -126,31 +229,34 @@ class DiffiTResBlock(nn.Module):
         """
         Transforms a batch of series of patches to a batch of unpatched images.
         :param x: Input tensor of size (batch_size, T, patch_size**2 * C)
-        :return: Output tensor of size (batch_size, H, W, C)
+        :return: Output tensor of size (batch_size, C, H, W), in channels last layout ( a view of an NHWC tensor )
         """
-        c = self.channels
-        p = self.x_embedder.patch_size[0]
-        h = w = int(x.shape[1] ** 0.5)
-        assert h * w == x.shape[1]
-
-        x = x.reshape(shape=(x.shape[0], h, w, p, p, c))
-        x = torch.einsum('nhwpqc->nchpwq', x)
-        imgs = x.reshape(shape=(x.shape[0], c, h * p, h * p))
+        x = x.reshape(shape=(x.shape[0], *self._patches_shape))
+        # (N, h, w, p, q, C) -> (N, h, p, w, q, C): a single copy, then the channels are moved with a view,
+        # so the result is already in channels last layout.
+        x = x.permute(0, 1, 3, 2, 4, 5).reshape(shape=(x.shape[0], *self._image_shape))
+        imgs = x.permute(0, 3, 1, 2)
         return imgs
 
-    def forward(self, x, c):
+    def forward(self, x, c, pos_embed):
         """
         :param x: Input tensor of shape (batch_size, channels, height, width).
         :param c: Context tensor for attention of size (batch_size, hidden_size), one for each input.
             It's usually a combination of label and temporal embedding.
+        :param pos_embed: fixed positional embedding of the patches, of size (1, num_patches, hidden_size).
+            It's shared by all the blocks working at the same resolution.
         :return: Output tensor of shape (batch_size, channels, height, width).
         """
-        x = self.conv2d(self.swish(self.groupNorm(x)))
+        x = self.conv2d(self.groupNorm(x))
         # Encoding input to pass it to transformer
-        x_patched = self.x_embedder(x) + self.pos_embed
+        # Added in place, saving an allocation. pos_embed is float32, or bfloat16 with "use_autocast", and it's cast
+        # to the dtype of the patches if they differ.
+        x_patched = self.x_embedder(x).add_(pos_embed)
         # (N, num_patches, hidden_size), where num_patches = (new_input_size / patch_size ) ** 2
         # Diffit -> Final  -> Unpatchify layer + Residual
-        x = self.unpatchify(self.final(self.diffit(x_patched, c))) + x  # (batch_size, channels, height, width)
+        x_unpatched = self.unpatchify(self.final(self.diffit(x_patched, c)))
+        # Keeping the channels last layout so that the residual sum doesn't need a layout conversion
+        x = x_unpatched.contiguous(memory_format=torch.channels_last) + x  # (batch_size, channels, height, width)
         return x
 
 
@@ -159,32 +265,53 @@ class DiffiTSequential(nn.Module):
     Just a sequential version of DiffiTResBlock, so that will be executed sequentially.
     """
 
-    def __init__(self, *blocks):
+    def __init__(self, *blocks, use_compile=False):
         """
         :param blocks: a bunch of DiffiTResBlocks.
+        :param use_compile: if true, the whole sequence of blocks is compiled as a single graph with torch.compile,
+            so that the residual sum of a block can be fused with the normalization of the following one.
         """
         super(DiffiTSequential, self).__init__()
         self.blocks = nn.ModuleList(blocks)
+        # If true, the activations of each block are recomputed in the backward pass instead of being stored
+        self.use_checkpoint = False
+        self.use_compile = use_compile
 
     @staticmethod
-    def all_equals(n, **kwargs):
+    def all_equals(n, use_compile=False, **kwargs):
         """
         Returns an instance of DiffiTSequential having n blocks with same input parameters.
         :param n: Nr of blocks.
+        :param use_compile: whether to compile the DiffiTSequential. See "DiffiTSequential".
         :param kwargs: parameters of class "DiffiTResBlock".
         :return: an instance of DiffiTSequential having n blocks with same input parameters.
         """
-        return DiffiTSequential(*[DiffiTResBlock(**kwargs) for _ in range(n)])
+        return DiffiTSequential(*[DiffiTResBlock(**kwargs) for _ in range(n)], use_compile=use_compile)
 
-    def forward(self, x, c):
+    def forward(self, x, c, pos_embed):
         """
         :param x: Input tensor of shape (batch_size, channels, height, width).
         :param c: Context tensor for attention of size (batch_size, hidden_size), one for each input.
             It's usually a combination of label and temporal embedding.
+        :param pos_embed: fixed positional embedding of the patches, of size (1, num_patches, hidden_size).
         :return: Output tensor of shape (batch_size, channels, height, width).
         """
+        # When the whole model is being compiled, the blocks are simply traced as part of its graph
+        if self.use_compile and not torch.compiler.is_compiling():
+            forward_blocks = _compiled(DiffiTSequential.forward_blocks, fullgraph=True,
+                                       mode="max-autotune-no-cudagraphs")
+            return forward_blocks(self, x, c, pos_embed)
+        return self.forward_blocks(x, c, pos_embed)
+
+    def forward_blocks(self, x, c, pos_embed):
+        """
+        Applies the blocks one after the other, without compilation. See "forward".
+        """
         for block in self.blocks:
-            x = block(x, c)  # Assuming each block takes x and xt
+            if self.use_checkpoint and torch.is_grad_enabled():
+                x = checkpoint(block, x, c, pos_embed, use_reentrant=False)
+            else:
+                x = block(x, c, pos_embed)
         return x
 
 
@@ -198,7 +325,8 @@ class ImageDiffiT(nn.Module):  # TODO Maybe implement "learn sigma"
     """
 
     def __init__(self, img_size, l1=4, l2=4, l3=4, l4=4, patch_size=2, num_classes=1000, class_dropout_prob=0.1,
-                 hidden_size=1152, channels=3, hidden_channels=128, num_heads=16, num_groups=8):
+                 hidden_size=1152, channels=3, hidden_channels=128, num_heads=16, num_groups=8, diffusion_steps=None,
+                 use_autocast=False, use_checkpoint=False, use_compile=False, compile_blocks=False):
         """
         :param l1: number of sequential Diffit Block in the first U-Net level
         :param l2: number of sequential Diffit Block in the second U-Net level
@@ -213,13 +341,31 @@ class ImageDiffiT(nn.Module):  # TODO Maybe implement "learn sigma"
         :param num_heads: the number of heads in the DiffitBlock transformer.
         :param class_dropout_prob: probability of dropping out class during training.
         :param num_classes: the total number of classes.
+        :param diffusion_steps: number of steps of the diffusion process. If given, the embeddings of the timesteps
+            in [0, diffusion_steps) are precomputed, and integer timesteps must then be in that range.
+            If None, timesteps are embedded on the fly, with no range limit.
+        :param use_autocast: if true, the forward passes run under bfloat16 autocast, using the tensor cores for
+            convolutions and attention. Outputs are returned in the dtype of the input.
+        :param use_checkpoint: if true, gradient checkpointing is applied to every DiffiT block during training:
+            activations are recomputed in the backward pass, reducing the memory used at the cost of some compute.
+            When combined with "use_compile" or "compile_blocks", it also sets the compiler activation memory budget
+            to 0.5: this is a process-wide setting, which applies to every other compiled model too.
+        :param use_compile: if true, the forward passes are compiled with torch.compile using CUDA Graphs
+            ( "reduce-overhead" mode ) and static shapes. Every new input shape triggers a recompilation.
+            The tensors returned by "forward" and "forward_with_cfg" live in the CUDA Graph memory and are
+            overwritten by the next call: a sampler keeping the previous output ( e.g. the previous eps ) must
+            .clone() it, or call torch.compiler.cudagraph_mark_step_begin() before the next call.
+        :param compile_blocks: if true, each sequence of DiffiT blocks, and the context embedding, are compiled as
+            single graphs.
+            Useful when the whole model is not compiled ( e.g. during training, where CUDA Graphs are not wanted ).
         """
         super(ImageDiffiT, self).__init__()
         assert hidden_size % num_heads == 0, 'hidden_size must be divisible by num_heads'
         assert hidden_channels % num_groups == 0, 'hidden_channels must be divisible by num_groups'
         self.num_classes = num_classes
+        self.use_autocast = use_autocast
         self.tokenizer = Tokenizer(in_channels=channels, out_channels=hidden_channels)
-        self.t_embedder = TimestepEmbedder(hidden_size=hidden_size)
+        self.t_embedder = TimestepEmbedder(hidden_size=hidden_size, num_timesteps=diffusion_steps)
         self.y_embedder = LabelEmbedder(num_classes, hidden_size, class_dropout_prob)
 
         def get_block_params(block_groups, block_img_size):
@@ -231,21 +377,45 @@ class ImageDiffiT(nn.Module):  # TODO Maybe implement "learn sigma"
                 "hidden_size": hidden_size, "channels": hidden_channels, "num_groups": block_groups
             }
 
-        self.resBlock1 = DiffiTSequential.all_equals(l1, **get_block_params(1, img_size))
+        # Fixed sin-cos positional embeddings, one for each U-Net level, shared by all the blocks of the level.
+        # With autocast they are stored directly in bfloat16, the dtype of the patches they are added to.
+        pos_embed_dtype = torch.bfloat16 if use_autocast else torch.float32
+        for level, level_img_size in enumerate((img_size, img_size // 2, img_size // 4, img_size // 8), start=1):
+            pos_embed = get_2d_sincos_pos_embed_torch(hidden_size, level_img_size // patch_size)
+            self.register_buffer(f"pos_embed_{level}", pos_embed.to(pos_embed_dtype).unsqueeze(0), persistent=False)
+
+        self.resBlock1 = DiffiTSequential.all_equals(l1, compile_blocks, **get_block_params(1, img_size))
         self.downsample_1 = nn.Conv2d(hidden_channels, hidden_channels, kernel_size=3, stride=2, padding=1)
-        self.resBlock2 = DiffiTSequential.all_equals(l2, **get_block_params(num_groups, img_size // 2))
+        self.resBlock2 = DiffiTSequential.all_equals(l2, compile_blocks, **get_block_params(num_groups, img_size // 2))
         self.downsample_2 = nn.Conv2d(hidden_channels, hidden_channels, kernel_size=3, stride=2, padding=1)
-        self.resBlock3 = DiffiTSequential.all_equals(l3, **get_block_params(num_groups, img_size // 4))
+        self.resBlock3 = DiffiTSequential.all_equals(l3, compile_blocks, **get_block_params(num_groups, img_size // 4))
         self.downsample_3 = nn.Conv2d(hidden_channels, hidden_channels, kernel_size=3, stride=2, padding=1)
-        self.resBlock4 = DiffiTSequential.all_equals(l4, **get_block_params(num_groups, img_size // 8))
-        self.upsample_1 = nn.ConvTranspose2d(hidden_channels, hidden_channels, kernel_size=4, stride=2, padding=1)
-        self.resBlock3up = DiffiTSequential.all_equals(l3, **get_block_params(num_groups, img_size // 4))
-        self.upsample_2 = nn.ConvTranspose2d(hidden_channels, hidden_channels, kernel_size=4, stride=2, padding=1)
-        self.resBlock2up = DiffiTSequential.all_equals(l2, **get_block_params(num_groups, img_size // 2))
-        self.upsample_3 = nn.ConvTranspose2d(hidden_channels, hidden_channels, kernel_size=4, stride=2, padding=1)
-        self.resBlock1Up = DiffiTSequential.all_equals(l1, **get_block_params(1, img_size))
+        self.resBlock4 = DiffiTSequential.all_equals(l4, compile_blocks, **get_block_params(num_groups, img_size // 8))
+        self.upsample_1 = Upsample2x(hidden_channels)
+        self.resBlock3up = DiffiTSequential.all_equals(l3, compile_blocks,
+                                                     **get_block_params(num_groups, img_size // 4))
+        self.upsample_2 = Upsample2x(hidden_channels)
+        self.resBlock2up = DiffiTSequential.all_equals(l2, compile_blocks,
+                                                     **get_block_params(num_groups, img_size // 2))
+        self.upsample_3 = Upsample2x(hidden_channels)
+        self.resBlock1Up = DiffiTSequential.all_equals(l1, compile_blocks, **get_block_params(1, img_size))
         self.head = Head()
         self.initialize_weights()
+        # Convolutions and group normalizations are faster in NHWC layout ( channels last ) on cuDNN
+        self.to(memory_format=torch.channels_last)
+
+        for module in self.modules():
+            if isinstance(module, DiffiTSequential):
+                module.use_checkpoint = use_checkpoint
+        if use_checkpoint and (use_compile or compile_blocks):
+            import torch._functorch.config as functorch_config
+            # Lets the compiler choose which activations to recompute, keeping half of the memory.
+            # Only available on recent PyTorch versions.
+            if hasattr(functorch_config, "activation_memory_budget"):
+                functorch_config.activation_memory_budget = 0.5
+
+        self.use_compile = use_compile
+        self.compile_blocks = compile_blocks
 
     def initialize_weights(self):
         def _basic_init(module):
@@ -263,61 +433,199 @@ class ImageDiffiT(nn.Module):  # TODO Maybe implement "learn sigma"
         nn.init.normal_(self.t_embedder.mlp[0].weight, std=0.02)
         nn.init.normal_(self.t_embedder.mlp[2].weight, std=0.02)
 
+    def to_inference(self, dtype=torch.bfloat16, quantization=None, calibration_loop=None):
+        """
+        Prepares the model for inference, casting its weights to a lower precision.
+        Group normalizations and the timestep embedder are kept in float32 for numerical stability.
+        Buffers are left as they are: the positional embeddings are float32, or bfloat16 if the model has been
+        built with "use_autocast".
+        Optionally, the model can be quantized with NVIDIA ModelOpt ( "nvidia-modelopt" package ):
+        - "fp8": all the linear and convolutional layers are quantized to FP8 (E4M3).
+        - "nvfp4": linear and convolutional layers are quantized to NVFP4, except the attention projections and
+          the final layers of the DiffiT blocks which are quantized to FP8 (E4M3).
+
+        :param dtype: dtype of the weights ( e.g. torch.bfloat16 or torch.float16 ).
+        :param quantization: None, "fp8" or "nvfp4". FP8 requires Hopper GPUs or newer, NVFP4 requires Blackwell.
+        :param calibration_loop: function that takes the model and runs it on some calibration data.
+            Required when quantization is used.
+        :return: the model itself, ready for inference.
+        """
+        if quantization is not None:
+            if quantization not in ("fp8", "nvfp4"):
+                raise ValueError(f"Unknown quantization '{quantization}', it must be one of: 'fp8', 'nvfp4'")
+            if calibration_loop is None:
+                raise ValueError(f"A calibration_loop is required for '{quantization}' quantization")
+        self.eval()
+        full_precision = {
+            id(param) for module in self.modules() if isinstance(module, (nn.GroupNorm, TimestepEmbedder))
+            for param in module.parameters()
+        }
+        for param in self.parameters():
+            if id(param) not in full_precision:
+                param.data = param.data.to(dtype)
+
+        if quantization is None:
+            return self
+        import modelopt.torch.quantization as mtq
+
+        fp8_cfg = mtq.FP8_DEFAULT_CFG["quant_cfg"]
+        if quantization == "fp8":
+            config = copy.deepcopy(mtq.FP8_DEFAULT_CFG)
+        else:
+            config = copy.deepcopy(mtq.NVFP4_DEFAULT_CFG)
+            # Attention projections and final layers are more sensitive: FP8 instead of NVFP4
+            for pattern in ("*tmsa.W_*", "*final*"):
+                config["quant_cfg"][pattern + "weight_quantizer"] = fp8_cfg["*weight_quantizer"]
+                config["quant_cfg"][pattern + "input_quantizer"] = fp8_cfg["*input_quantizer"]
+        config["quant_cfg"]["*t_embedder*"] = {"enable": False}
+        return mtq.quantize(self, config, forward_loop=calibration_loop)
+
+    def build_graph(self, example_x, example_t, example_y, warmup_steps=3):
+        """
+        Captures the forward pass in a CUDA Graph, which is then replayed by the "step" method of the returned
+        runner, removing the CPU overhead of launching the kernels at every diffusion step.
+        The graph works only with inputs having the same shape, dtype and device of the examples: in particular the
+        batch size is fixed. To use another batch size, another graph must be built.
+        The model must be on a CUDA device, and it's put in evaluation mode.
+        It can't be used with "use_compile" or "compile_blocks", since the eager forward pass is captured.
+        The graph is kept in the runner, not in the model, which can still be deep-copied and pickled.
+
+        :param example_x: (batch_size, channels, input_size, input_size) tensor of spatial inputs (squared image)
+        :param example_t: (batch_size,) tensor of diffusion timesteps, one per each image
+        :param example_y: (batch_size,) tensor of class labels, one per each image
+        :param warmup_steps: number of forward passes run before the capture.
+        :return: a "CUDAGraphRunner" replaying the captured forward pass.
+        """
+        assert not (self.use_compile or self.compile_blocks), 'CUDA Graphs can be captured only from the eager model'
+        self.eval()
+        return CUDAGraphRunner(self._forward_impl, example_x, example_t, example_y, warmup_steps)
+
+    def build_context(self, t, y):
+        """
+        Creates the context tensor given to all the DiffiT blocks.
+        The context is shared by all the blocks: when only the blocks are compiled ( "compile_blocks" ), it gets its
+        own graph too, without CUDA Graphs like the blocks.
+
+        :param t: (batch_size,) tensor of diffusion timesteps, one per each image
+        :param y: (batch_size * k,) tensor of class labels. If k > 1, the same timesteps are used for each of the k
+            groups of labels ( e.g. guided and null labels in "forward_with_cfg" ).
+        :return: (batch_size * k, hidden_size) tensor, combination of timestep and label embeddings.
+        """
+        if self.compile_blocks and not torch.compiler.is_compiling():
+            build_context = _compiled(ImageDiffiT._build_context, mode="max-autotune-no-cudagraphs")
+            return build_context(self, t, y)
+        return self._build_context(t, y)
+
+    def _build_context(self, t, y):
+        """
+        Actual creation of the context tensor. See "build_context".
+        """
+        xt = self.t_embedder(t)  # Timestep embedding: (batch_size, hidden_size)
+        return self._combine_context(xt, y)
+
+    def _combine_context(self, xt, y):
+        """
+        Combines already computed timestep embeddings with the embeddings of the labels.
+
+        :param xt: (batch_size, hidden_size) tensor of timestep embeddings.
+        :param y: (batch_size * k,) tensor of class labels. The timestep embeddings are repeated k times.
+        :return: (batch_size * k, hidden_size) tensor, combination of timestep and label embeddings.
+        """
+        xl = self.y_embedder(y)  # Label embedding: (batch_size * k, hidden_size)
+        repeats = y.shape[0] // xt.shape[0]
+        if repeats > 1:
+            xt = torch.cat([xt] * repeats, dim=0)
+        # The timestep embedder may be kept in higher precision ( see "to_inference" )
+        return xt.to(xl.dtype) + xl
+
     def forward(self, x, t, y):
         """
         Forward pass of the ImageDiffiT model.
+        If the model has been built with "use_compile", the compiled version is used.
 
         :param x: (batch_size, channels, input_size, input_size) tensor of spatial inputs (squared image)
         :param t: (batch_size,) tensor of diffusion timesteps, one per each image
         :param y: (batch_size,) tensor of class labels, one per each image
         :return: (batch_size, channels, input_size, input_size) tensor of spatial outputs (squared image)
         """
-        # Generate embeddings for timesteps and labels
-        xt = self.t_embedder(t)  # Timestep embedding: (batch_size, hidden_size)
-        xl = self.y_embedder(y)  # Label embedding: (batch_size, hidden_size)
-        c = xt + xl  # Combine timestep and label embeddings: (batch_size, hidden_size)
+        if self.use_compile:
+            forward_impl = _compiled(ImageDiffiT._forward_impl, mode="reduce-overhead", fullgraph=True, dynamic=False)
+            return forward_impl(self, x, t, y)
+        return self._forward_impl(x, t, y)
 
-        # Tokenize input image
-        x1 = self.tokenizer(x)  # Convert image to feature maps: (batch_size, hidden_channels, input_size, input_size)
+    def _forward_impl(self, x, t, y):
+        """
+        Actual forward pass of the ImageDiffiT model. See "forward".
+        """
+        input_dtype = x.dtype
+        with self._autocast(x):
+            # Generate the context from timesteps and labels, used by all the blocks
+            c = self.build_context(t, y)  # (batch_size, hidden_size)
+
+            # Tokenize input image
+            x = x.to(dtype=self.tokenizer.conv2d.weight.dtype, memory_format=torch.channels_last)
+            x1 = self.tokenizer(x)  # Feature maps: (batch_size, hidden_channels, input_size, input_size)
+            x = self._forward_unet(x1, c)
+        return x.to(input_dtype)
+
+    def _autocast(self, x):
+        """
+        :param x: the input of the model, used to know the device type.
+        :return: the bfloat16 autocast context used by the forward passes, enabled only if "use_autocast" is set.
+        """
+        return torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=self.use_autocast)
+
+    def _forward_unet(self, x1, c):
+        """
+        U-Net part of the forward pass, from the tokenized image to the output.
 
+        :param x1: (batch_size, hidden_channels, input_size, input_size) tensor of feature maps from the tokenizer.
+        :param c: (batch_size, hidden_size) context tensor, combination of timestep and label embeddings.
+        :return: (batch_size, channels, input_size, input_size) tensor of spatial outputs (squared image)
+        """
         # Encoder (downsampling) path
-        x1 = self.resBlock1(x1, c)  # First level of U-Net: (batch_size, hidden_channels, input_size, input_size)
-        x2 = self.downsample_1(
-            x1)  # Downsample to half resolution: (batch_size, hidden_channels, input_size/2, input_size/2)
-        x2 = self.resBlock2(x2, c)  # Second level of U-Net: (batch_size, hidden_channels, input_size/2, input_size/2)
-        x3 = self.downsample_2(
-            x2)  # Downsample to quarter resolution: (batch_size, hidden_channels, input_size/4, input_size/4)
-        x3 = self.resBlock3(x3, c)  # Third level of U-Net: (batch_size, hidden_channels, input_size/4, input_size/4)
-        x4 = self.downsample_3(
-            x3)  # Downsample to eighth resolution: (batch_size, hidden_channels, input_size/8, input_size/8)
-        x4 = self.resBlock4(x4,
-                            c)  # Fourth (bottom) level of U-Net: (batch_size, hidden_channels, input_size/8, input_size/8)
-
-        # Decoder (upsampling) path with skip connections
-        x3 = x3 + self.upsample_1(
-            x4)  # Upsample and add skip connection: (batch_size, hidden_channels, input_size/4, input_size/4)
-        x3 = self.resBlock3up(x3,
-                              c)  # Process upsampled features: (batch_size, hidden_channels, input_size/4, input_size/4)
-        x2 = x2 + self.upsample_2(
-            x3)  # Upsample and add skip connection: (batch_size, hidden_channels, input_size/2, input_size/2)
-        x2 = self.resBlock2(x2,
-                            c)  # Process upsampled features: (batch_size, hidden_channels, input_size/2, input_size/2)
-        x1 = x1 + self.upsample_3(
-            x2)  # Upsample and add skip connection: (batch_size, hidden_channels, input_size, input_size)
-        x1 = self.resBlock1Up(x1,
-                              c)  # Process final upsampled features: (batch_size, hidden_channels, input_size, input_size)
+        # First level of U-Net: (batch_size, hidden_channels, input_size, input_size)
+        x1 = self.resBlock1(x1, c, self.pos_embed_1)
+        # Downsample to half resolution: (batch_size, hidden_channels, input_size/2, input_size/2)
+        x2 = self.downsample_1(x1)
+        # Second level of U-Net: (batch_size, hidden_channels, input_size/2, input_size/2)
+        x2 = self.resBlock2(x2, c, self.pos_embed_2)
+        # Downsample to quarter resolution: (batch_size, hidden_channels, input_size/4, input_size/4)
+        x3 = self.downsample_2(x2)
+        # Third level of U-Net: (batch_size, hidden_channels, input_size/4, input_size/4)
+        x3 = self.resBlock3(x3, c, self.pos_embed_3)
+        # Downsample to eighth resolution: (batch_size, hidden_channels, input_size/8, input_size/8)
+        x4 = self.downsample_3(x3)
+        # Fourth (bottom) level of U-Net: (batch_size, hidden_channels, input_size/8, input_size/8)
+        x4 = self.resBlock4(x4, c, self.pos_embed_4)
+
+        # Decoder (upsampling) path with skip connections.
+        # Skip connections are added in place to the upsampled tensor, which has the same layout ( channels last )
+        # and dtype of the skip tensor, so no new tensor is allocated.
+        # Upsample and add skip connection: (batch_size, hidden_channels, input_size/4, input_size/4)
+        x3 = self.upsample_1(x4).add_(x3)
+        # Process upsampled features: (batch_size, hidden_channels, input_size/4, input_size/4)
+        x3 = self.resBlock3up(x3, c, self.pos_embed_3)
+        # Upsample and add skip connection: (batch_size, hidden_channels, input_size/2, input_size/2)
+        x2 = self.upsample_2(x3).add_(x2)
+        # Process upsampled features: (batch_size, hidden_channels, input_size/2, input_size/2)
+        x2 = self.resBlock2up(x2, c, self.pos_embed_2)
+        # Upsample and add skip connection: (batch_size, hidden_channels, input_size, input_size)
+        x1 = self.upsample_3(x2).add_(x1)
+        # Process final upsampled features: (batch_size, hidden_channels, input_size, input_size)
+        x1 = self.resBlock1Up(x1, c, self.pos_embed_1)
 
         # Generate final output
         x = self.head(x1)  # Convert feature maps to output image: (batch_size, channels, input_size, input_size)
 
         return x
 
-    def forward_with_cfg(self, x, t, y, cfg_scale):
+    def forward_with_cfg(self, x, t, y, cfg_scale, return_half=False):
         """
         Forward pass of the model with a 3-channels classifiers free guidance.
         Basically it works in the following way:
-        - The input x is repeated twice creating a new batch.
-        - The input t is repeated twice creating a new batch.
+        - The input x is tokenized and the feature maps are repeated twice creating a new batch.
+        - The input t is embedded and the embeddings are repeated twice creating a new batch.
         - The input y is concatenated to a batch of the same size in which each element is a "null" label ( which in
         this case is "null_classes" ).
         The model will predict the noise of each image 2 times: one guided ( when there is the label ) and
@@ -329,30 +637,103 @@ class ImageDiffiT(nn.Module):  # TODO Maybe implement "learn sigma"
         :param x: (batch_size, channels, input_size, input_size) tensor of spatial inputs (squared image)
         :param t: (batch_size,) tensor of diffusion timesteps, one per each image.
         :param y: (batch_size,) tensor of class labels, one per each image.
-        :return: (batch_size*2, channels, input_size, input_size) tensor of spatial inputs (squared image)
+        :param return_half: if true, only the guided half of the batch is returned, avoiding to duplicate the output.
+        :return: (batch_size*2, channels, input_size, input_size) tensor of spatial inputs (squared image), or
+            (batch_size, channels, input_size, input_size) if "return_half" is true.
+        """
+        if self.use_compile:
+            # forward_with_cfg works on a doubled batch, so it gets its own graph
+            forward_with_cfg_impl = _compiled(ImageDiffiT._forward_with_cfg_impl, mode="reduce-overhead",
+                                              fullgraph=True, dynamic=False)
+            return forward_with_cfg_impl(self, x, t, y, cfg_scale, return_half)
+        return self._forward_with_cfg_impl(x, t, y, cfg_scale, return_half)
+
+    def _forward_with_cfg_impl(self, x, t, y, cfg_scale, return_half=False):
+        """
+        Actual forward pass with classifier free guidance. See "forward_with_cfg".
         """
         # https://github.com/openai/glide-text2im/blob/main/notebooks/text2im.ipynb
-        combined = torch.cat([x, x], dim=0)
-        combined_times = torch.cat([t, t], dim=0)
-        null_labels = torch.full((x.shape[0],),
-                                 self.num_classes)  # "self.num_classes" is the special class for "no class"
+        # "self.num_classes" is the special class for "no class". Created directly on the device of the labels
+        # to avoid a host to device copy ( which also breaks the CUDA Graph capture ).
+        null_labels = torch.full_like(y, self.num_classes)
         combined_labels = torch.cat([y, null_labels], dim=0)
-        model_out = self.forward(combined, combined_times, combined_labels)
+        # The two halves differ only by the labels, which are injected in every DiffiT block: everything coming
+        # before the first block ( timestep embedding and tokenizer ) is computed once on the original batch.
+        with self._autocast(x):
+            c = self.build_context(t, combined_labels)  # (batch_size * 2, hidden_size)
+            x1 = self.tokenizer(x.to(dtype=self.tokenizer.conv2d.weight.dtype, memory_format=torch.channels_last))
+            model_out = self._forward_unet(torch.cat([x1, x1], dim=0), c)
+        # Guidance is computed in the dtype of the input
+        model_out = model_out.to(x.dtype)
         # Eps: first 3 channels
         # Rest: remaining channels ( usually none )
         eps, rest = model_out[:, :3], model_out[:, 3:]
         # This is only about the first 3 channels
         # cond_eps: noise generated conditionally
         # uncond_eps: noise generated unconditionally.
-        cond_eps, uncond_eps = torch.split(eps, len(eps) // 2, dim=0)
+        cond_eps, uncond_eps = torch.split(eps, eps.shape[0] // 2, dim=0)
         # The noise is combined between the 2 using the weight "cfg scale"
         half_eps = uncond_eps + cfg_scale * (cond_eps - uncond_eps)
-        # The batch is "doubled" going back to the original shape TODO why is it useful? Can't we just use half?
+        if return_half:
+            return torch.cat([half_eps, rest[:x.shape[0]]], dim=1)
+        # The batch is "doubled" going back to the original shape, as expected by samplers working on doubled batches
         eps = torch.cat([half_eps, half_eps], dim=0)
         # The three channels are combined with the rest - untouched
         return torch.cat([eps, rest], dim=1)
 
 
+class CUDAGraphRunner:
+    """
+    Forward pass of a model captured in a CUDA Graph, built by "ImageDiffiT.build_graph".
+    The inputs are copied in static tensors and the graph is replayed, without launching the kernels one by one.
+    """
+
+    def __init__(self, forward, example_x, example_t, example_y, warmup_steps=3):
+        """
+        :param forward: the forward function to capture, taking x, t and y.
+        :param example_x: (batch_size, channels, input_size, input_size) tensor of spatial inputs (squared image)
+        :param example_t: (batch_size,) tensor of diffusion timesteps, one per each image
+        :param example_y: (batch_size,) tensor of class labels, one per each image
+        :param warmup_steps: number of forward passes run before the capture.
+        """
+        # Static inputs: "step" copies the new inputs here before replaying the graph
+        self.static_x = example_x.clone()
+        self.static_t = example_t.clone()
+        self.static_y = example_y.clone()
+        with torch.no_grad():
+            # Warm up on a side stream, as required before capturing ( e.g. by cuDNN benchmark and autocast caches )
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(warmup_steps):
+                    forward(self.static_x, self.static_t, self.static_y)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.static_out = forward(self.static_x, self.static_t, self.static_y)
+
+    def step(self, x, t, y):
+        """
+        Runs the forward pass replaying the captured CUDA Graph.
+
+        :param x: (batch_size, channels, input_size, input_size) tensor of spatial inputs (squared image)
+        :param t: (batch_size,) tensor of diffusion timesteps, one per each image
+        :param y: (batch_size,) tensor of class labels, one per each image
+        :return: (batch_size, channels, input_size, input_size) tensor of spatial outputs (squared image).
+            It's a static tensor, overwritten by the next call: it must be cloned to be kept across steps.
+        """
+        # copy_ would broadcast smaller inputs over the whole static batch
+        assert x.shape == self.static_x.shape, f'x must have shape {tuple(self.static_x.shape)}'
+        assert t.shape == self.static_t.shape, f't must have shape {tuple(self.static_t.shape)}'
+        assert y.shape == self.static_y.shape, f'y must have shape {tuple(self.static_y.shape)}'
+        self.static_x.copy_(x)
+        self.static_t.copy_(t)
+        self.static_y.copy_(y)
+        self.graph.replay()
+        return self.static_out
+
+
 ################## Tests ##########################
 def main(testing=True):
     if not testing:
@@ -165,8 +165,8 @@ class LatentDiffiT(nn.Module):  # TODO maybe we can implement "learn sigma"
         # https://github.com/openai/glide-text2im/blob/main/notebooks/text2im.ipynb
         combined = torch.cat([x, x], dim=0)
         combined_times = torch.cat([t, t], dim=0)
-        null_labels = torch.full((x.shape[0],),
-                                 self.num_classes)  # "self.num_classes" is the special class for "no class"
+        # "self.num_classes" is the special class for "no class". Created directly on the device of the labels.
+        null_labels = torch.full_like(y, self.num_classes)
         combined_labels = torch.cat([y, null_labels], dim=0)
         model_out = self.forward(combined, combined_times, combined_labels)
         # Eps: first 3 channels
@@ -175,7 +175,7 @@ class LatentDiffiT(nn.Module):  # TODO maybe we can implement "learn sigma"
         # This is only about the first 3 channels
         # cond_eps: noise generated conditionally
         # uncond_eps: noise generated unconditionally.
-        cond_eps, uncond_eps = torch.split(eps, len(eps) // 2, dim=0)
+        cond_eps, uncond_eps = torch.split(eps, eps.shape[0] // 2, dim=0)
         # The noise is combined between the 2 using the weight "cfg scale"
         half_eps = uncond_eps + cfg_scale * (cond_eps - uncond_eps)
         # The batch is "doubled" going back to the original shape TODO why is it useful? Can't we just use half?
@@ -8,7 +8,7 @@ from torch.utils.data import DataLoader
 from torchvision import transforms, datasets
 
 from autoencoders.pretrained_autoencoder import PretrainedAutoEncoder
-from image_diffit import ImageDiffiT
+from image_diffit import ImageDiffiT, setup_cuda_backends
 from latent_diffit import LatentDiffiT
 from scripts.utils import ArgumentParser
 from training import DiffiTTrainer
@@ -61,6 +61,7 @@ def train_latent_model(config_file: str = 'train_parameters.yaml') -> None:
     print(f"Training using: {device}")
     if torch.cuda.is_available():
         print(f"Using CUDA: {torch.cuda.get_device_name(0)}")
+        setup_cuda_backends()
 
     save_folder = params['save_folder']
     dataset_folder = params['dataset_folder']
@@ -84,7 +85,7 @@ def train_latent_model(config_file: str = 'train_parameters.yaml') -> None:
         num_classes=params['num_classes'],
         num_groups=params['num_groups'],
         hidden_channels=params['hidden_channels'],
-
+        diffusion_steps=params['diffusion_steps'],
     )
     model = model.to(device)
     loss = getattr(nn, params['loss_function'])()
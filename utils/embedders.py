@@ -12,11 +12,14 @@ class TimestepEmbedder(nn.Module):
      - Pass the vector representations through a MLP.
     """
 
-    def __init__(self, hidden_size=512, frequency_embedding_size=256):
+    def __init__(self, hidden_size=512, frequency_embedding_size=256, num_timesteps=None):
         """
         :param hidden_size: hidden size and size of the final reppresentations.
         :param frequency_embedding_size: size of the frequency embeddings. It's the size it uses
         to embed scalar timesteps before feeding into the network.
+        :param num_timesteps: if given, the frequency embeddings of the integer timesteps in [0, num_timesteps) are
+        precomputed in a table, and integer timesteps are embedded with a lookup instead of computing them.
+        In that case integer timesteps must be in [0, num_timesteps); floating point timesteps are always computed.
         """
         super().__init__()
         self.mlp = nn.Sequential(
@@ -25,6 +28,10 @@ class TimestepEmbedder(nn.Module):
             nn.Linear(hidden_size, hidden_size, bias=True),
         )
         self.frequency_embedding_size = frequency_embedding_size
+        freq_table = None
+        if num_timesteps is not None:
+            freq_table = self.timestep_embedding(torch.arange(num_timesteps), frequency_embedding_size)
+        self.register_buffer("freq_table", freq_table, persistent=False)
 
     @staticmethod
     def timestep_embedding(t, dim, max_period=10000):
@@ -40,8 +47,8 @@ class TimestepEmbedder(nn.Module):
         # https://github.com/openai/glide-text2im/blob/main/glide_text2im/nn.py
         half = dim // 2
         freqs = torch.exp(
-            -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half
-        ).to(device=t.device)
+            -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32, device=t.device) / half
+        )
         args = t[:, None].float() * freqs[None]
         embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
         if dim % 2:
@@ -53,7 +60,10 @@ class TimestepEmbedder(nn.Module):
         :param t: a tensor of shape (batch_size, timesteps) reppresenting the timesteps to be encoded.
         :return: the encoded timestep representations in a tensor of shape (batch_size, hidden_size).
         """
-        t_freq = self.timestep_embedding(t, self.frequency_embedding_size)
+        if self.freq_table is not None and not torch.is_floating_point(t):
+            t_freq = self.freq_table[t]
+        else:
+            t_freq = self.timestep_embedding(t, self.frequency_embedding_size)
         t_emb = self.mlp(t_freq)
         return t_emb
 
@@ -3,6 +3,7 @@
 #################################################################################
 # https://github.com/facebookresearch/mae/blob/main/util/pos_embed.py
 import numpy as np
+import torch
 
 
 def get_2d_sincos_pos_embed(embed_dim, grid_size, cls_token=False, extra_tokens=0):
@@ -53,3 +54,44 @@ def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
 
     emb = np.concatenate([emb_sin, emb_cos], axis=1)  # (M, D)
     return emb
+
+
+def get_2d_sincos_pos_embed_torch(embed_dim, grid_size, device=None):
+    """
+    Same as get_2d_sincos_pos_embed ( without cls_token ), computed with torch directly on the target device.
+    grid_size: int of the grid height and width
+    device: device on which the embedding is created
+    return:
+    pos_embed: float32 tensor of shape [grid_size*grid_size, embed_dim]
+    """
+    assert embed_dim % 4 == 0
+    coords = torch.arange(grid_size, dtype=torch.float64, device=device)
+    grid_h, grid_w = torch.meshgrid(coords, coords, indexing="ij")
+
+    # as in get_2d_sincos_pos_embed_from_grid, the first half encodes the w coordinate
+    emb_w = get_1d_sincos_pos_embed_from_grid_torch(embed_dim // 2, grid_w)  # (H*W, D/2)
+    emb_h = get_1d_sincos_pos_embed_from_grid_torch(embed_dim // 2, grid_h)  # (H*W, D/2)
+
+    emb = torch.cat([emb_w, emb_h], dim=1)  # (H*W, D)
+    return emb.float()
+
+
+def get_1d_sincos_pos_embed_from_grid_torch(embed_dim, pos):
+    """
+    Same as get_1d_sincos_pos_embed_from_grid, computed with torch.
+    embed_dim: output dimension for each position
+    pos: a tensor of positions to be encoded: size (M,)
+    out: (M, D)
+    """
+    assert embed_dim % 2 == 0
+    omega = torch.arange(embed_dim // 2, dtype=torch.float64, device=pos.device)
+    omega /= embed_dim / 2.
+    omega = 1. / 10000 ** omega  # (D/2,)
+
+    out = torch.outer(pos.reshape(-1).double(), omega)  # (M, D/2), outer product
+
+    emb_sin = torch.sin(out)  # (M, D/2)
+    emb_cos = torch.cos(out)  # (M, D/2)
+
+    emb = torch.cat([emb_sin, emb_cos], dim=1)  # (M, D)
+    return emb